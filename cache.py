@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+logger = logging.getLogger("__cache__")
+
+CACHE_DIR = "cache"
+MAX_ENTRIES = 10000
+
+
+def digest(value):
+    """Return a stable sha256 digest of a template body or a list of parameters"""
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+class ChangeSetCache:
+    """
+    Persistent LRU cache of change set evaluation results, one file per source stackset.
+    An entry is keyed by stack id, template, parameters and capabilities digests and the
+    last updated time of the stack, so any change on one of them invalidates it.
+    """
+
+    def __init__(self, name: str, max_entries: int = MAX_ENTRIES) -> None:
+        self.path = os.path.join(CACHE_DIR, f"change_set_cache_{name}.json")
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Load the cache from disk, an unreadable cache is ignored"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Could not read change set cache {self.path}. Starting empty.")
+            return
+        if not isinstance(data, dict):
+            logger.warning(f"Invalid change set cache {self.path}. Starting empty.")
+            return
+        # Drop entries from a hand edit or an older format
+        self.entries = OrderedDict(
+            (stack_id, entry)
+            for stack_id, entry in data.items()
+            if isinstance(entry, dict)
+            and isinstance(entry.get("key"), str)
+            and isinstance(entry.get("changes"), int)
+        )
+
+    def save(self):
+        """Write the cache to disk through a temporary file so an interrupted run can't corrupt it"""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def key(stack_id, template_digest, parameters_digest, capabilities_digest, last_updated):
+        return "|".join(
+            [stack_id, template_digest, parameters_digest, capabilities_digest, str(last_updated)]
+        )
+
+    def get(self, stack_id, key):
+        """Return the cached number of changes for the stack or None"""
+        entry = self.entries.get(stack_id)
+        if entry is None or entry["key"] != key:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(stack_id)
+        self.hits += 1
+        return entry["changes"]
+
+    def put(self, stack_id, key, changes):
+        """Store the number of changes for the stack, evicting the least recently used entries"""
+        self.entries[stack_id] = {"key": key, "changes": changes}
+        self.entries.move_to_end(stack_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
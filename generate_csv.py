@@ -7,17 +7,23 @@ stacksets = {}
 
 for file in os.listdir('.'):
     if file.startswith('report_stackset_'):
-        stack_set_name = re.match("report_stackset_(.*)-(drift|noncurrent|parameter|extras)\.txt",file)[1]
-        report_type = re.match("report_stackset_(.*)-(drift|noncurrent|parameter|extras)\.txt",file)[2]
-        
-        num_lines = sum(1 if line.startswith('arn') else 0 for line in open(file))
+        match = re.match("report_stackset_(.*)-(drift|noncurrent|parameter|extras|regions)\.txt",file)
+        if not match:
+            continue
+        stack_set_name = match[1]
+        report_type = match[2]
+
+        if report_type == 'regions':
+            num_lines = sum(1 if line.split(',')[1] in ('CREATE', 'DELETE') else 0 for line in open(file))
+        else:
+            num_lines = sum(1 if line.startswith('arn') else 0 for line in open(file))
         if not stack_set_name in stacksets:
             stacksets[stack_set_name] = {}
         stacksets[stack_set_name][report_type] = num_lines
 
 
 with open('summary.csv', 'w') as outfile:
-    fieldnames = ['name', 'drifts', 'non_currents', 'parameters', 'extras_instances']
+    fieldnames = ['name', 'drifts', 'non_currents', 'parameters', 'extras_instances', 'region_fixes']
     writer = csv.DictWriter(outfile, fieldnames=fieldnames)
 
     writer.writeheader()
@@ -30,5 +36,6 @@ with open('summary.csv', 'w') as outfile:
             drifts=value.get('drift'),
             non_currents=value.get('noncurrent'),
             parameters=value.get('parameter'),
-            extras_instances=value.get('extras')
+            extras_instances=value.get('extras'),
+            region_fixes=value.get('regions')
         ))
\ No newline at end of file
@@ -30,9 +30,9 @@
 """
 
 import argparse
-import itertools
 import sys
 import time
+from collections import Counter
 
 import boto3
 
@@ -41,6 +41,7 @@ import difflib
 
 from botocore.exceptions import ClientError
 from utils import assume_role, get_accounts_from_ou, get_all_accounts
+from cache import ChangeSetCache, digest
 
 
 ACCOUNTS = []
@@ -67,7 +68,9 @@ class StackSet:
         self.template = None
         self.ous = []
         self.target_accounts = []
+        self.ou_accounts = {}
         self.extra_stacks = []
+        self.region_targets = {}
         self.execution_role_name = ""
         self.capabilities = []
 
@@ -164,24 +167,81 @@ class StackSet:
         """
         Check if the stack instances are uniformly deployed across
         AWS Regions (ou-a -> region a, ou-b -> region a...)
+        Every deployed account must have the same set of regions.
         """
-        instances_map = {}
-        for instance in self.instances:
-            region = instance.split(":")[3]
-            if region in instances_map:
-                instances_map[region] += 1
-            else:
-                instances_map[region] = 1
-        self.regions = list(instances_map.keys())
-        regions = itertools.groupby(instances_map.values())
-        next(regions, None)
-        if next(regions, None) is None:
+        regions, matrix = self.build_region_matrix()
+        self.regions = regions
+        masks = Counter(matrix.values())
+        if len(masks) <= 1:
+            self.region_targets = {}
             return False
         logger.info(
             "stack instances are not deployed to the same regions across all accounts"
         )
+        self.region_targets = self.analyze_regions(regions, matrix, masks)
         return True
 
+    def build_region_matrix(self):
+        """
+        Build the account x region presence matrix in a single pass over the instances.
+        Each account maps to a bitset (int) where bit i is set if the account has a
+        stack instance in regions[i].
+        """
+        regions = {}
+        matrix = {}
+        for instance in self.instances:
+            region, account = instance.split(":")[3:5]
+            bit = regions.setdefault(region, len(regions))
+            matrix[account] = matrix.get(account, 0) | (1 << bit)
+        return list(regions), matrix
+
+    def analyze_regions(self, regions, matrix, masks):
+        """
+        Report per OU the (account, region) cells to create or delete to make the
+        deployment uniform. The target regions are shared by all OUs: a region is kept
+        if at least half of the deployed accounts have it, otherwise it is removed.
+        Accounts of an OU without any stack instance don't count and are reported as empty.
+        """
+        target = 0
+        for i in range(len(regions)):
+            bit = 1 << i
+            present = sum(count for mask, count in masks.items() if mask & bit)
+            if 2 * present >= len(matrix):
+                target |= bit
+
+        # Stacksets without OU (self managed) are evaluated as a single group of accounts.
+        # An account is reported under its most specific OU (ou- before r-).
+        account_ous = {}
+        for ou in sorted(self.ou_accounts):
+            for account in self.ou_accounts[ou]:
+                account_ous.setdefault(account, ou)
+        default_ou = "NO_OU" if self.ou_accounts else "ALL"
+
+        targets = {}
+        for account, mask in matrix.items():
+            if mask == target:
+                continue
+            ou = account_ous.get(account, default_ou)
+            cells = targets.setdefault(ou, {"Create": {}, "Delete": {}, "Empty": []})
+            for i, region in enumerate(regions):
+                bit = 1 << i
+                if target & bit and not mask & bit:
+                    cells["Create"].setdefault(region, []).append(account)
+                elif mask & bit and not target & bit:
+                    cells["Delete"].setdefault(region, []).append(account)
+        for account, ou in account_ous.items():
+            if account not in matrix:
+                targets.setdefault(ou, {"Create": {}, "Delete": {}, "Empty": []})["Empty"].append(account)
+
+        for ou, cells in targets.items():
+            for region, _accounts in cells["Create"].items():
+                logger.info(f"{ou}: {len(_accounts)} accounts are missing region {region}")
+            for region, _accounts in cells["Delete"].items():
+                logger.info(f"{ou}: {len(_accounts)} accounts have extra region {region}")
+            if cells["Empty"]:
+                logger.info(f"{ou}: {len(cells['Empty'])} accounts have no stack instance")
+        return targets
+
     def detect_drift(self):
         """Start the detection of the drift for the stackset and wait for its completion"""
         client = session.client("cloudformation")
@@ -258,14 +318,25 @@ class StackSet:
         with open(f"reports/report_stackset_{self.name}-extras.txt", "w") as f:
             f.write("\n".join(self.extra_stacks))
 
+    def generate_region_report(self):
+        with open(f"reports/report_stackset_{self.name}-regions.txt", "w") as f:
+            for ou, target in self.region_targets.items():
+                for action in ["Create", "Delete"]:
+                    for region, _accounts in target[action].items():
+                        for account in _accounts:
+                            f.write(f"{ou},{action.upper()},{account},{region}\n")
+                for account in target["Empty"]:
+                    f.write(f"{ou},EMPTY,{account},\n")
+
     def get_target_accounts(self):
         _accounts = []
         for ou in self.ous:
             logger.info(f"Get all accounts for OU {ou}")
             if ou.startswith("ou-"):
-                _accounts.extend(get_accounts_from_ou(session, ou))
+                self.ou_accounts[ou] = get_accounts_from_ou(session, ou)
             elif ou.startswith("r-"):
-                _accounts.extend(get_all_accounts(session))
+                self.ou_accounts[ou] = get_all_accounts(session)
+            _accounts.extend(self.ou_accounts.get(ou, []))
         final_list = list(set(_accounts))
         logger.info(
             f"Evaluated targets to {len(final_list)} accounts for this Stackset"
@@ -293,6 +364,7 @@ def setup_args():
         action="store_true",
     )
     parser.add_argument("-c", "--change-set", help="Enable change set evaluation for each stack instance", action="store_true")
+    parser.add_argument("-n", "--no-cache", help="Disable the local cache of change set results", action="store_true")
     parsed_args = parser.parse_args()
     if parsed_args.change_set and not parsed_args.target_stack_set_name:
         print("Can't check change set without a target stack set. Please add --target-stack-set-name")
@@ -304,12 +376,25 @@ def setup_args():
     return parsed_args
   
 
-def evaluate_change_set(stack_instance:str, target_stack_set:StackSet):
+def evaluate_change_set(stack_instance:str, target_stack_set:StackSet, cache:ChangeSetCache=None):
     logger.info(f"Evaluating a change set for {stack_instance}")
     account_id = stack_instance.split(':')[4]
     region = stack_instance.split(':')[3]
     _session = assume_role(account_id,target_stack_set.execution_role_name,region)
     _client = _session.client('cloudformation')
+    if cache:
+        stack = _client.describe_stacks(StackName=stack_instance)['Stacks'][0]
+        key = cache.key(
+            stack_instance,
+            digest(target_stack_set.template),
+            digest(target_stack_set.parameters),
+            digest(target_stack_set.capabilities),
+            stack.get('LastUpdatedTime', stack['CreationTime']),
+        )
+        changes = cache.get(stack_instance, key)
+        if changes is not None:
+            logger.info(f"Using cached change set result for {stack_instance}")
+            return changes
     response = _client.create_change_set(
         StackName=stack_instance,
         TemplateBody=target_stack_set.template,
@@ -334,10 +419,15 @@ def evaluate_change_set(stack_instance:str, target_stack_set:StackSet):
             ChangeSetName = changeset_id
         )
     
-    if response['Status'] == 'FAILED' and response['StatusReason'] == NO_CHANGES:
-        return 0
+    no_changes = response['Status'] == 'FAILED' and response['StatusReason'] == NO_CHANGES
+    if no_changes:
+        changes = 0
     else:
-        return len(response['Changes'])
+        changes = len(response['Changes'])
+    # Only cache conclusive results, failed or pending change sets are evaluated again next run
+    if cache and (no_changes or response['Status'] == 'CREATE_COMPLETE'):
+        cache.put(stack_instance, key, changes)
+    return changes
 
 
 def instance_already_exist(instance, instances):
@@ -347,7 +437,7 @@ def instance_already_exist(instance, instances):
     return False
 
 
-def compare_stack_sets(source_stack_set:StackSet, target_stack_set:StackSet=None, detect_change_set=False):
+def compare_stack_sets(source_stack_set:StackSet, target_stack_set:StackSet=None, detect_change_set=False, use_cache=True):
     exit_code = 0
     
     # check if there are some drifted stacks
@@ -372,8 +462,11 @@ def compare_stack_sets(source_stack_set:StackSet, target_stack_set:StackSet=None
         exit_code=1
     
     # Check if stackset is deployed uniformly on AWS regions
-    if source_stack_set.evaluate_regions():
+    non_uniform_regions = source_stack_set.evaluate_regions()
+    source_stack_set.generate_region_report()
+    if non_uniform_regions:
         logger.error("This stackset is not deployed to the same regions for all accounts. Please fix the account and regions first.")
+        logger.info(f"Suggested stack instances to create or delete are listed in reports/report_stackset_{source_stack_set.name}-regions.txt")
         exit_code=1
         
     if target_stack_set:
@@ -401,9 +494,18 @@ def compare_stack_sets(source_stack_set:StackSet, target_stack_set:StackSet=None
     # Check if a change set will be triggered by migrating   
     if target_stack_set and detect_change_set:
         change_set = []
-        for i in source_stackset.instances:
-            if evaluate_change_set(i, target_stackset) > 0:
-                change_set.append(i)
+        cache = None
+        if use_cache:
+            cache = ChangeSetCache(source_stack_set.name)
+            cache.load()
+        try:
+            for i in source_stackset.instances:
+                if evaluate_change_set(i, target_stackset, cache) > 0:
+                    change_set.append(i)
+        finally:
+            if cache:
+                cache.save()
+                logger.info(f"Change set cache: {cache.hits} hits, {cache.misses} misses")
         if len(change_set)>0:
             logger.error("ChangeSet identified changes. Please review to the following stacks to review the change.")
             logger.error("ChangeSet should be DELETED after review, otherwise it will cause a drift")
@@ -480,7 +582,7 @@ if __name__ == "__main__":
         # Runs on all instances
         source_stackset.filtered_instances = source_stackset.instances
 
-    compare_stack_sets(source_stackset,target_stackset, args.change_set)
+    compare_stack_sets(source_stackset,target_stackset, args.change_set, not args.no_cache)
 
     # Exit if there is not target stack to migrate to.
     if not args.target_stack_set_name: